@@ -123,6 +123,16 @@ CREATE TABLE IF NOT EXISTS olist_dw.dim_product (
   width_cm INT
 );
 
+-- Referência: UFs do Brasil (usada nas regras de validade do monitoramento de DQ)
+CREATE TABLE IF NOT EXISTS olist_dw.ref_uf (
+  code CHAR(2) PRIMARY KEY
+);
+INSERT INTO olist_dw.ref_uf (code) VALUES
+  ('AC'),('AL'),('AP'),('AM'),('BA'),('CE'),('DF'),('ES'),('GO'),
+  ('MA'),('MT'),('MS'),('MG'),('PA'),('PB'),('PR'),('PE'),('PI'),
+  ('RJ'),('RN'),('RS'),('RO'),('RR'),('SC'),('SP'),('SE'),('TO')
+ON CONFLICT (code) DO NOTHING;
+
 -- FATO (grão: item do pedido)
 CREATE TABLE IF NOT EXISTS olist_dw.fact_order_item (
   fact_id BIGSERIAL PRIMARY KEY,
@@ -154,6 +164,45 @@ CREATE TABLE IF NOT EXISTS olist_dw.fact_payment (
   CONSTRAINT uq_pay UNIQUE (order_id, payment_sequential)
 );
 
+-- Totais por pedido para a conciliação pagamentos x itens do monitoramento de DQ
+-- (cada lado é agregado antes do JOIN para não multiplicar linhas).
+-- payment_rows/item_rows indicam se o pedido tem linhas de cada lado; os totais
+-- ficam NULL quando todos os valores são NULL (e a regra de DQ conta como falha).
+-- Atualizada ao final do ETL com REFRESH MATERIALIZED VIEW CONCURRENTLY.
+
+-- versões anteriores da view não tinham as contagens: recria se for o caso
+DO $$
+BEGIN
+  IF to_regclass('olist_dw.mv_order_totals') IS NOT NULL
+     AND NOT EXISTS (SELECT 1 FROM pg_attribute
+                     WHERE attrelid = to_regclass('olist_dw.mv_order_totals')
+                       AND attname = 'item_rows') THEN
+    DROP MATERIALIZED VIEW olist_dw.mv_order_totals;
+  END IF;
+END $$;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS olist_dw.mv_order_totals AS
+SELECT COALESCE(p.order_id, i.order_id) AS order_id,
+       COALESCE(p.payment_rows, 0) AS payment_rows,
+       p.payments_total,
+       COALESCE(i.item_rows, 0) AS item_rows,
+       i.items_total
+FROM (
+  SELECT order_id, COUNT(*) AS payment_rows, SUM(payment_value) AS payments_total
+  FROM olist_stage.raw_payments
+  WHERE order_id IS NOT NULL
+  GROUP BY order_id
+) p
+FULL OUTER JOIN (
+  SELECT order_id, COUNT(*) AS item_rows, SUM(price + freight_value) AS items_total
+  FROM olist_stage.raw_order_items
+  WHERE order_id IS NOT NULL
+  GROUP BY order_id
+) i ON i.order_id = p.order_id;
+
+-- índice único: exigido pelo REFRESH ... CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_order_totals ON olist_dw.mv_order_totals(order_id);
+
 -- ====== Índices ======
 CREATE INDEX IF NOT EXISTS ix_fact_item_purchase ON olist_dw.fact_order_item(purchase_date_id);
 CREATE INDEX IF NOT EXISTS ix_fact_item_seller   ON olist_dw.fact_order_item(seller_sk);
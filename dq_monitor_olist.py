@@ -4,10 +4,13 @@
 Monitoramento de Qualidade de Dados (DQ) para o DW do Olist
 - Conecta ao PostgreSQL via SQLAlchemy
 - Calcula métricas para 5+ dimensões: COMPLETENESS, UNIQUENESS, VALIDITY, CONSISTENCY, TIMELINESS
-- Gera gráficos (matplotlib) e CSVs em ./monitoring/
+- Gera gráficos (matplotlib; histograma com Pillow) e um snapshot parquet
+  (CSVs opcionais com --csv) em ./monitoring/
 
 Requisitos:
-    pip install SQLAlchemy psycopg2-binary python-dotenv pandas matplotlib
+    pip install SQLAlchemy psycopg2-binary python-dotenv pandas matplotlib pillow pyarrow
+Uso:
+    python dq_monitor_olist.py [--no-cache] [--csv]
 Config .env (na raiz do projeto ou mesmo diretório):
     DB_HOST=localhost
     DB_PORT=5432
@@ -16,10 +19,21 @@ Config .env (na raiz do projeto ou mesmo diretório):
     DB_PASSWORD=postgres123
 """
 import os
+import json
+import hashlib
+import argparse
+import threading
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg")  # só gera PNGs: evita a detecção de backend GUI
 import matplotlib.pyplot as plt
+from PIL import Image, ImageDraw
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import URL
 
@@ -27,7 +41,8 @@ from sqlalchemy.engine import URL
 load_dotenv()
 OUTPUT_PLOTS = Path("monitoring/plots")
 OUTPUT_CSV   = Path("monitoring/csv")
-for d in [OUTPUT_PLOTS, OUTPUT_CSV]:
+CACHE_DIR    = Path("monitoring/cache")
+for d in [OUTPUT_PLOTS, OUTPUT_CSV, CACHE_DIR]:
     d.mkdir(parents=True, exist_ok=True)
 
 url = URL.create(
@@ -38,190 +53,394 @@ url = URL.create(
     port=int(os.getenv("DB_PORT","5432")),
     database=os.getenv("DB_NAME","olist"),
 )
-engine = create_engine(url, pool_pre_ping=True)
+# Pool dimensionado para as dimensões rodarem em paralelo (uma conexão por thread)
+engine = create_engine(url, pool_pre_ping=True, pool_size=8, max_overflow=0)
+
+@contextmanager
+def dq_session():
+    """
+    Transação para as consultas de DQ, com parallel seq scan habilitado no Postgres.
+    SET LOCAL vale só para esta transação.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL max_parallel_workers_per_gather = 4"))
+        yield conn
+
+# --- Cache local de resultados ---
+USE_CACHE = True   # desligado com --no-cache (força reexecução e regrava o cache)
+CACHE_INDEX = CACHE_DIR / "index.json"
+_cache_lock = threading.Lock()
+
+# Tabelas que o ETL atualiza por upsert/REFRESH CONCURRENTLY (nunca TRUNCATE): o relfilenode
+# não muda e os contadores de pg_stat_user_tables não são transacionais (zeram com
+# pg_stat_reset() ou crash recovery). Para elas a assinatura inclui também COUNT(*) e
+# MAX(xmin), que mudam a cada linha inserida/atualizada. São tabelas pequenas.
+_UPSERT_TABLES = {
+    "olist_dw.dim_customer", "olist_dw.dim_seller", "olist_dw.dim_product",
+    "olist_dw.dim_date", "olist_dw.ref_uf", "olist_dw.mv_order_totals",
+}
+
+def _table_versions(conn, tables):
+    """
+    Assinatura barata do estado das tabelas lidas por uma consulta:
+    relfilenode muda a cada TRUNCATE e os contadores de pg_stat_user_tables
+    mudam a cada INSERT/UPDATE/DELETE; nas tabelas de _UPSERT_TABLES soma-se
+    COUNT(*) e MAX(xmin), que não dependem das estatísticas.
+    """
+    rows = conn.execute(text("""
+      SELECT t.name, c.relfilenode,
+             COALESCE(s.n_tup_ins,0), COALESCE(s.n_tup_upd,0), COALESCE(s.n_tup_del,0)
+      FROM unnest(CAST(:tables AS TEXT[])) AS t(name)
+      JOIN pg_class c ON c.oid = t.name::regclass
+      LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+      ORDER BY t.name
+    """), {"tables": list(tables)}).all()
+    versions = []
+    for row in rows:
+        version = list(row)
+        if row[0] in _UPSERT_TABLES:
+            version += list(conn.execute(text(
+                f"SELECT COUNT(*), COALESCE(MAX(xmin::text::bigint),0) FROM {row[0]}"
+            )).one())
+        versions.append(version)
+    return versions
+
+def _read_cache_index():
+    if not CACHE_INDEX.exists():
+        return {}
+    try:
+        return json.loads(CACHE_INDEX.read_text(encoding="utf-8"))
+    except json.JSONDecodeError:
+        # índice corrompido (ex.: execução interrompida): trata como cache vazio
+        return {}
+
+def _write_cache_index(index):
+    # grava num temporário e troca com os.replace (atômico): o índice nunca fica pela metade
+    tmp = CACHE_DIR / f"{CACHE_INDEX.name}.{os.getpid()}.tmp"
+    tmp.write_text(json.dumps(index, indent=2), encoding="utf-8")
+    os.replace(tmp, CACHE_INDEX)
+
+def cached_sql(conn, sql, tables, params=None):
+    """
+    Equivalente a pd.read_sql, mas reaproveita o último resultado salvo em
+    monitoring/cache/ quando o SQL (normalizado) e as tabelas lidas não mudaram.
+    """
+    normalized = " ".join(sql.split())
+    key = hashlib.sha1((normalized + json.dumps(params or {}, sort_keys=True)).encode("utf-8")).hexdigest()
+    versions = _table_versions(conn, tables)
+
+    if USE_CACHE:
+        with _cache_lock:
+            entry = _read_cache_index().get(key)
+        if entry and entry["versions"] == versions:
+            try:
+                return pd.read_parquet(CACHE_DIR / entry["path"])
+            except (FileNotFoundError, pa.ArrowInvalid):
+                pass  # arquivo apagado ou truncado: trata como miss e regrava abaixo
+
+    df = pd.read_sql(text(sql), conn, params=params)
+    fname = f"{key}.parquet"
+    # mesmo esquema do índice: temporário + os.replace, nunca um parquet pela metade
+    tmp = CACHE_DIR / f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, CACHE_DIR / fname)
+    with _cache_lock:
+        index = _read_cache_index()
+        index[key] = {"versions": versions, "path": fname}
+        _write_cache_index(index)
+    return df
+
+# Uma única Figure/Axes reaproveitada em todos os gráficos (ax.clear() entre eles):
+# criar Axes a cada gráfico (spines, ticks) custa mais que desenhar as barras.
+# Os gráficos são gerados só na thread principal (ver main()).
+_FIG, _AX = plt.subplots(figsize=(10,5))
 
 def save_bar(df, x, y, title, fname):
-    import matplotlib.pyplot as plt
-    plt.figure(figsize=(10,5))
-    plt.bar(df[x], df[y])
-    plt.title(title)
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.savefig(OUTPUT_PLOTS / fname, dpi=140)
-    plt.close()
-
-def save_hist(series, bins, title, fname):
-    import matplotlib.pyplot as plt
-    plt.figure(figsize=(8,5))
-    plt.hist(series.dropna(), bins=bins)
-    plt.title(title)
-    plt.tight_layout()
-    plt.savefig(OUTPUT_PLOTS / fname, dpi=140)
-    plt.close()
+    _AX.clear()
+    _AX.bar(df[x], df[y])
+    _AX.set_title(title)
+    plt.setp(_AX.get_xticklabels(), rotation=45, ha='right')
+    _FIG.tight_layout()
+    _FIG.savefig(OUTPUT_PLOTS / fname, dpi=140)
+
+def save_hist(df, title, fname, w=1120, h=700):
+    """
+    Histograma já agregado no banco (uma barra por faixa [bin_lo, bin_hi)),
+    desenhado direto com Pillow: são só ~30 retângulos, sem Axes do matplotlib.
+    """
+    img = Image.new("RGB", (w, h), "white")
+    draw = ImageDraw.Draw(img)
+    left, right, top, bottom = 60, 20, 40, 40
+    draw.text(((w - draw.textlength(title)) / 2, top / 3), title, fill="black")
+
+    if not df.empty:
+        plot_w, plot_h = w - left - right, h - top - bottom
+        x_lo, x_hi = float(df["bin_lo"].min()), float(df["bin_hi"].max())
+        peak = int(df["cnt"].max())
+        scale_x = plot_w / (x_hi - x_lo)
+        # posição pelas bordas da faixa: faixas vazias não voltam do GROUP BY
+        for lo, hi, cnt in df[["bin_lo", "bin_hi", "cnt"]].itertuples(index=False):
+            x0 = left + (float(lo) - x_lo) * scale_x
+            x1 = left + (float(hi) - x_lo) * scale_x
+            draw.rectangle([x0, h - bottom - cnt / peak * plot_h, max(x0, x1 - 2), h - bottom],
+                           fill=(31, 119, 180))
+        # eixos: limites das faixas e contagem máxima
+        draw.line([left, h - bottom, w - right, h - bottom], fill="black")
+        draw.line([left, top, left, h - bottom], fill="black")
+        lo_txt, hi_txt, peak_txt = f"{x_lo:g}", f"{x_hi:g}", str(peak)
+        draw.text((left, h - bottom + 6), lo_txt, fill="black")
+        draw.text((w - right - draw.textlength(hi_txt), h - bottom + 6), hi_txt, fill="black")
+        draw.text((left - 6 - draw.textlength(peak_txt), top), peak_txt, fill="black")
+    img.save(OUTPUT_PLOTS / fname)
+
+def unpivot(df, var_name, value_name):
+    """Converte o resultado de linha única (uma coluna por métrica) em formato longo."""
+    return (df.melt(var_name=var_name, value_name=value_name)
+              .sort_values(var_name)
+              .reset_index(drop=True))
 
 # ------------------ 1) COMPLETENESS ------------------
 def completeness():
+    # Um único scan por tabela: cada coluna do SELECT é uma métrica (tabela.coluna)
     sql = """
-    WITH
-      f AS (
-        SELECT 'fact_order_item' AS entity, 'price' AS col,
-               100.0*SUM(CASE WHEN price IS NOT NULL THEN 1 ELSE 0 END)/COUNT(*) AS pct
-        FROM olist_dw.fact_order_item
-        UNION ALL
-        SELECT 'fact_order_item','freight_value',
-               100.0*SUM(CASE WHEN freight_value IS NOT NULL THEN 1 ELSE 0 END)/COUNT(*)
-        FROM olist_dw.fact_order_item
-        UNION ALL
-        SELECT 'fact_order_item','purchase_date_id',
-               100.0*SUM(CASE WHEN purchase_date_id IS NOT NULL THEN 1 ELSE 0 END)/COUNT(*)
-        FROM olist_dw.fact_order_item
-        UNION ALL
-        SELECT 'dim_customer','city',
-               100.0*SUM(CASE WHEN city IS NOT NULL THEN 1 ELSE 0 END)/COUNT(*)
-        FROM olist_dw.dim_customer
-        UNION ALL
-        SELECT 'dim_customer','state',
-               100.0*SUM(CASE WHEN state IS NOT NULL THEN 1 ELSE 0 END)/COUNT(*)
-        FROM olist_dw.dim_customer
-        UNION ALL
-        SELECT 'dim_product','category_name',
-               100.0*SUM(CASE WHEN category_name IS NOT NULL THEN 1 ELSE 0 END)/COUNT(*)
-        FROM olist_dw.dim_product
-      )
-    SELECT entity || '.' || col AS feature, ROUND(pct,2) AS completeness_pct
-    FROM f
-    ORDER BY feature;
+    SELECT f.*, c.*, p.*
+    FROM (
+      SELECT ROUND(100.0*COUNT(price)/COUNT(*),2)            AS "fact_order_item.price",
+             ROUND(100.0*COUNT(freight_value)/COUNT(*),2)    AS "fact_order_item.freight_value",
+             ROUND(100.0*COUNT(purchase_date_id)/COUNT(*),2) AS "fact_order_item.purchase_date_id"
+      FROM olist_dw.fact_order_item
+    ) f
+    CROSS JOIN (
+      SELECT ROUND(100.0*COUNT(city)/COUNT(*),2)  AS "dim_customer.city",
+             ROUND(100.0*COUNT(state)/COUNT(*),2) AS "dim_customer.state"
+      FROM olist_dw.dim_customer
+    ) c
+    CROSS JOIN (
+      SELECT ROUND(100.0*COUNT(category_name)/COUNT(*),2) AS "dim_product.category_name"
+      FROM olist_dw.dim_product
+    ) p;
     """
-    with engine.begin() as conn:
-        df = pd.read_sql(text(sql), conn)
-    df.to_csv(OUTPUT_CSV / "completeness.csv", index=False)
-    save_bar(df, "feature", "completeness_pct", "Completeness (%) por coluna crítica", "01_completeness.png")
+    with dq_session() as conn:
+        df = cached_sql(conn, sql, ["olist_dw.fact_order_item", "olist_dw.dim_customer", "olist_dw.dim_product"])
+    df = unpivot(df, "feature", "completeness_pct")
     return df
 
 # ------------------ 2) UNIQUENESS ------------------
 def uniqueness():
+    # GROUP BY em subconsulta (HashAggregate) em vez de COUNT(DISTINCT ...), que força sort.
+    # Chaves simples: WHERE ... IS NOT NULL mantém o resultado do COUNT(DISTINCT), que
+    # ignora NULLs (toda linha com chave NULL conta como duplicata).
     sql = """
-    SELECT 'raw_orders.order_id' AS entity, COUNT(*) - COUNT(DISTINCT order_id) AS duplicates
-    FROM olist_stage.raw_orders
+    SELECT 'raw_orders.order_id' AS entity,
+           (SELECT COUNT(*) FROM olist_stage.raw_orders)
+         - (SELECT COUNT(*) FROM (SELECT order_id FROM olist_stage.raw_orders WHERE order_id IS NOT NULL
+                                  GROUP BY order_id) s) AS duplicates
     UNION ALL
-    SELECT 'raw_customers.customer_id', COUNT(*) - COUNT(DISTINCT customer_id)
-    FROM olist_stage.raw_customers
+    SELECT 'raw_customers.customer_id',
+           (SELECT COUNT(*) FROM olist_stage.raw_customers)
+         - (SELECT COUNT(*) FROM (SELECT customer_id FROM olist_stage.raw_customers WHERE customer_id IS NOT NULL
+                                  GROUP BY customer_id) s)
     UNION ALL
-    SELECT 'raw_sellers.seller_id', COUNT(*) - COUNT(DISTINCT seller_id)
-    FROM olist_stage.raw_sellers
+    SELECT 'raw_sellers.seller_id',
+           (SELECT COUNT(*) FROM olist_stage.raw_sellers)
+         - (SELECT COUNT(*) FROM (SELECT seller_id FROM olist_stage.raw_sellers WHERE seller_id IS NOT NULL
+                                  GROUP BY seller_id) s)
     UNION ALL
-    SELECT 'raw_products.product_id', COUNT(*) - COUNT(DISTINCT product_id)
-    FROM olist_stage.raw_products
+    SELECT 'raw_products.product_id',
+           (SELECT COUNT(*) FROM olist_stage.raw_products)
+         - (SELECT COUNT(*) FROM (SELECT product_id FROM olist_stage.raw_products WHERE product_id IS NOT NULL
+                                  GROUP BY product_id) s)
     UNION ALL
     SELECT 'raw_order_items(order_id,order_item_id)',
-           COUNT(*) - COUNT(DISTINCT (order_id, order_item_id))
-    FROM olist_stage.raw_order_items
+           (SELECT COUNT(*) FROM olist_stage.raw_order_items)
+         - (SELECT COUNT(*) FROM (SELECT order_id, order_item_id FROM olist_stage.raw_order_items
+                                  GROUP BY order_id, order_item_id) s)
     UNION ALL
     SELECT 'raw_payments(order_id,payment_sequential)',
-           COUNT(*) - COUNT(DISTINCT (order_id, payment_sequential))
-    FROM olist_stage.raw_payments;
+           (SELECT COUNT(*) FROM olist_stage.raw_payments)
+         - (SELECT COUNT(*) FROM (SELECT order_id, payment_sequential FROM olist_stage.raw_payments
+                                  GROUP BY order_id, payment_sequential) s);
     """
-    with engine.begin() as conn:
-        df = pd.read_sql(text(sql), conn)
-    df.to_csv(OUTPUT_CSV / "uniqueness.csv", index=False)
-    save_bar(df, "entity", "duplicates", "Duplicatas por chave natural (staging)", "02_uniqueness.png")
+    with dq_session() as conn:
+        # memória suficiente para o HashAggregate não cair para sort em disco
+        conn.execute(text("SET LOCAL work_mem = '256MB'"))
+        df = cached_sql(conn, sql, ["olist_stage.raw_orders", "olist_stage.raw_customers",
+                                    "olist_stage.raw_sellers", "olist_stage.raw_products",
+                                    "olist_stage.raw_order_items", "olist_stage.raw_payments"])
     return df
 
 # ------------------ 3) VALIDITY ------------------
 def validity():
-    valid_states = ("'AC','AL','AP','AM','BA','CE','DF','ES','GO','MA','MT','MS','MG','PA','PB','PR','PE','PI','RJ','RN','RS','RO','RR','SC','SP','SE','TO'")
-    sql = f"""
-    WITH v AS (
-      SELECT 'price>0' AS rule, 100.0*AVG(CASE WHEN price>0 THEN 1 ELSE 0 END) AS pass_pct
-      FROM olist_stage.raw_order_items
-      UNION ALL
-      SELECT 'freight>=0', 100.0*AVG(CASE WHEN freight_value>=0 THEN 1 ELSE 0 END)
+    # Um único scan por tabela: cada coluna do SELECT é uma regra.
+    # UFs válidas vêm de olist_dw.ref_uf (populada pelo ddl_olist.sql): probe em hashed SubPlan.
+    sql = """
+    SELECT i.*, s.*, c.*, p.*
+    FROM (
+      SELECT ROUND(100.0*AVG(CASE WHEN price>0 THEN 1 ELSE 0 END),2)          AS "price>0",
+             ROUND(100.0*AVG(CASE WHEN freight_value>=0 THEN 1 ELSE 0 END),2) AS "freight>=0"
       FROM olist_stage.raw_order_items
-      UNION ALL
-      SELECT 'seller_state in UF', 100.0*AVG(CASE WHEN seller_state IN ({valid_states}) THEN 1 ELSE 0 END)
+    ) i
+    CROSS JOIN (
+      SELECT ROUND(100.0*AVG(CASE WHEN seller_state IN (SELECT code FROM olist_dw.ref_uf) THEN 1 ELSE 0 END),2)
+               AS "seller_state in UF"
       FROM olist_stage.raw_sellers
-      UNION ALL
-      SELECT 'customer_state in UF', 100.0*AVG(CASE WHEN customer_state IN ({valid_states}) THEN 1 ELSE 0 END)
+    ) s
+    CROSS JOIN (
+      SELECT ROUND(100.0*AVG(CASE WHEN customer_state IN (SELECT code FROM olist_dw.ref_uf) THEN 1 ELSE 0 END),2)
+               AS "customer_state in UF"
       FROM olist_stage.raw_customers
-      UNION ALL
-      SELECT 'dims>0 (produto)', 100.0*AVG(CASE WHEN COALESCE(product_weight_g,1)>0
-                                                AND COALESCE(product_length_cm,1)>0
-                                                AND COALESCE(product_height_cm,1)>0
-                                                AND COALESCE(product_width_cm,1)>0
-                                           THEN 1 ELSE 0 END)
+    ) c
+    CROSS JOIN (
+      SELECT ROUND(100.0*AVG(CASE WHEN COALESCE(product_weight_g,1)>0
+                                   AND COALESCE(product_length_cm,1)>0
+                                   AND COALESCE(product_height_cm,1)>0
+                                   AND COALESCE(product_width_cm,1)>0
+                              THEN 1 ELSE 0 END),2) AS "dims>0 (produto)"
       FROM olist_stage.raw_products
-    )
-    SELECT rule, ROUND(pass_pct,2) AS pass_pct FROM v ORDER BY rule;
+    ) p;
     """
-    with engine.begin() as conn:
-        df = pd.read_sql(text(sql), conn)
-    df.to_csv(OUTPUT_CSV / "validity.csv", index=False)
-    save_bar(df, "rule", "pass_pct", "Validity: % linhas que passam as regras", "03_validity.png")
-    return df
+    with dq_session() as conn:
+        df = cached_sql(conn, sql, ["olist_stage.raw_order_items", "olist_stage.raw_sellers",
+                                    "olist_stage.raw_customers", "olist_stage.raw_products",
+                                    "olist_dw.ref_uf"])
+    return unpivot(df, "rule", "pass_pct")
 
 # ------------------ 4) CONSISTENCY ------------------
 def consistency():
     sql = """
-    WITH
-    rules AS (
-      -- se status entregue, data de entrega não nula e >= compra
-      SELECT 'delivered_has_date' AS rule,
-             100.0*AVG(CASE WHEN order_status = 'delivered'
-                               THEN CASE WHEN order_delivered_customer_date IS NOT NULL THEN 1 ELSE 0 END
-                               ELSE 1 END) AS pass_pct
+    SELECT o.*, s.*, t.*
+    FROM (
+      -- se status entregue, data de entrega não nula e >= compra (um único scan em raw_orders)
+      SELECT ROUND(100.0*AVG(CASE WHEN order_status = 'delivered'
+                                    THEN CASE WHEN order_delivered_customer_date IS NOT NULL THEN 1 ELSE 0 END
+                                    ELSE 1 END),2) AS "delivered_has_date",
+             ROUND(100.0*AVG(CASE WHEN order_status = 'delivered'
+                                    THEN CASE WHEN order_delivered_customer_date >= order_purchase_timestamp THEN 1 ELSE 0 END
+                                    ELSE 1 END),2) AS "delivered_after_purchase"
       FROM olist_stage.raw_orders
-      UNION ALL
-      SELECT 'delivered_after_purchase',
-             100.0*AVG(CASE WHEN order_status = 'delivered'
-                               THEN CASE WHEN order_delivered_customer_date >= order_purchase_timestamp THEN 1 ELSE 0 END
-                               ELSE 1 END)
-      FROM olist_stage.raw_orders
-      UNION ALL
-      SELECT 'shipping_limit_after_purchase',
-             100.0*AVG(CASE WHEN shipping_limit_date >= o.order_purchase_timestamp THEN 1 ELSE 0 END)
+    ) o
+    CROSS JOIN (
+      SELECT ROUND(100.0*AVG(CASE WHEN shipping_limit_date >= o.order_purchase_timestamp THEN 1 ELSE 0 END),2)
+               AS "shipping_limit_after_purchase"
       FROM olist_stage.raw_order_items i
       JOIN olist_stage.raw_orders o ON o.order_id = i.order_id
-      UNION ALL
-      -- pagamentos ~= soma itens (tolerância 1.00)
-      SELECT 'sum(payments)≈sum(items)',
-             100.0*AVG(CASE WHEN abs(payments.total - items.total) <= 1.00 THEN 1 ELSE 0 END)
-      FROM (
-        SELECT order_id, SUM(payment_value) AS total
-        FROM olist_stage.raw_payments GROUP BY order_id
-      ) payments
-      JOIN (
-        SELECT order_id, SUM(price + freight_value) AS total
-        FROM olist_stage.raw_order_items GROUP BY order_id
-      ) items USING(order_id)
-    )
-    SELECT rule, ROUND(pass_pct,2) AS pass_pct FROM rules ORDER BY rule;
+    ) s
+    CROSS JOIN (
+      -- pagamentos ~= soma itens (tolerância 1.00), sobre os totais já agregados no ETL;
+      -- só pedidos com linhas de pagamento e de item, como no JOIN original.
+      -- Totais NULL (valores todos NULL) continuam contando como falha.
+      SELECT ROUND(100.0*AVG(CASE WHEN abs(payments_total - items_total) <= 1.00 THEN 1 ELSE 0 END),2)
+               AS "sum(payments)≈sum(items)"
+      FROM olist_dw.mv_order_totals
+      WHERE payment_rows > 0 AND item_rows > 0
+    ) t;
     """
-    with engine.begin() as conn:
-        df = pd.read_sql(text(sql), conn)
-    df.to_csv(OUTPUT_CSV / "consistency.csv", index=False)
-    save_bar(df, "rule", "pass_pct", "Consistency: % linhas que passam as regras", "04_consistency.png")
+    with dq_session() as conn:
+        df = cached_sql(conn, sql, ["olist_stage.raw_orders", "olist_stage.raw_order_items",
+                                    "olist_dw.mv_order_totals"])
+    df = unpivot(df, "rule", "pass_pct")
     return df
 
 # ------------------ 5) TIMELINESS ------------------
 def timeliness():
     # Histograma do lead time e taxa de entrega no prazo
+    # O histograma é agregado no Postgres (width_bucket): só as faixas trafegam pela rede.
+    # Faixas de mesma largura entre o menor e o maior lead time (como o plt.hist fazia).
     sql_lead = """
-      SELECT (DATE(order_delivered_customer_date) - DATE(order_purchase_timestamp))::INT AS lead_time_days
-      FROM olist_stage.raw_orders
-      WHERE order_delivered_customer_date IS NOT NULL AND order_purchase_timestamp IS NOT NULL
+      WITH lead AS (
+        SELECT (DATE(order_delivered_customer_date) - DATE(order_purchase_timestamp))::INT AS lead_days
+        FROM olist_stage.raw_orders
+        WHERE order_delivered_customer_date IS NOT NULL AND order_purchase_timestamp IS NOT NULL
+      ),
+      bounds AS (
+        SELECT MIN(lead_days) AS lo, MAX(lead_days) + 1 AS hi FROM lead
+      )
+      SELECT ROUND(b.lo + (g.bucket - 1) * (b.hi - b.lo) / CAST(:bins AS NUMERIC), 2) AS bin_lo,
+             ROUND(b.lo + g.bucket       * (b.hi - b.lo) / CAST(:bins AS NUMERIC), 2) AS bin_hi,
+             g.cnt
+      FROM (
+        SELECT width_bucket(l.lead_days, b.lo, b.hi, :bins) AS bucket, COUNT(*) AS cnt
+        FROM lead l CROSS JOIN bounds b
+        GROUP BY bucket
+      ) g
+      CROSS JOIN bounds b
+      ORDER BY g.bucket
     """
     sql_ontime = """
       SELECT 100.0*AVG(CASE WHEN order_delivered_customer_date <= order_estimated_delivery_date THEN 1 ELSE 0 END) AS ontime_pct
       FROM olist_stage.raw_orders
       WHERE order_delivered_customer_date IS NOT NULL AND order_estimated_delivery_date IS NOT NULL
     """
-    with engine.begin() as conn:
-        lead_df = pd.read_sql(text(sql_lead), conn)
-        ontime_df = pd.read_sql(text(sql_ontime), conn)
+    with dq_session() as conn:
+        lead_df = cached_sql(conn, sql_lead, ["olist_stage.raw_orders"], params={"bins": 30})
+        ontime_df = cached_sql(conn, sql_ontime, ["olist_stage.raw_orders"])
+    return lead_df, ontime_df
+
+def snapshot(results):
+    """
+    Junta as métricas de todas as dimensões num único DataFrame longo
+    (dimension, metric, value), gravado em monitoring/snapshot.parquet.
+    """
+    lead_df, ontime_df = results["timeliness"]
+    lead = pd.DataFrame({
+        "metric": [f"lead_time_days[{float(lo):g},{float(hi):g})" for lo, hi in zip(lead_df["bin_lo"], lead_df["bin_hi"])],
+        "value": lead_df["cnt"],
+    })
+    ontime = pd.DataFrame({"metric": ["on_time_delivery_rate"], "value": ontime_df["ontime_pct"].round(2)})
+    parts = [
+        ("completeness", results["completeness"].set_axis(["metric", "value"], axis=1)),
+        ("uniqueness",   results["uniqueness"].set_axis(["metric", "value"], axis=1)),
+        ("validity",     results["validity"].set_axis(["metric", "value"], axis=1)),
+        ("consistency",  results["consistency"].set_axis(["metric", "value"], axis=1)),
+        ("timeliness",   lead),
+        ("timeliness",   ontime),
+    ]
+    df = pd.concat([part.assign(dimension=dim) for dim, part in parts], ignore_index=True)
+    df["value"] = df["value"].astype(float)
+    return df[["dimension", "metric", "value"]]
+
+def write_csvs(results):
+    lead_df, ontime_df = results["timeliness"]
+    results["completeness"].to_csv(OUTPUT_CSV / "completeness.csv", index=False)
+    results["uniqueness"].to_csv(OUTPUT_CSV / "uniqueness.csv", index=False)
+    results["validity"].to_csv(OUTPUT_CSV / "validity.csv", index=False)
+    results["consistency"].to_csv(OUTPUT_CSV / "consistency.csv", index=False)
     lead_df.to_csv(OUTPUT_CSV / "timeliness_leadtime.csv", index=False)
     ontime_df.to_csv(OUTPUT_CSV / "timeliness_ontime.csv", index=False)
 
-    save_hist(lead_df["lead_time_days"], bins=30, title="Distribuição do Lead Time (dias)", fname="05_timeliness_lead_hist.png")
+def main():
+    global USE_CACHE
+    parser = argparse.ArgumentParser(description="Monitoramento de Qualidade de Dados (DW Olist)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignora o cache em monitoring/cache/ e reexecuta todas as consultas")
+    parser.add_argument("--csv", action="store_true",
+                        help="também grava um CSV por dimensão em monitoring/csv/")
+    args = parser.parse_args()
+    USE_CACHE = not args.no_cache
+
+    print("[DQ] Iniciando monitoramento...")
+    # As dimensões não dependem umas das outras: cada uma roda em sua própria sessão
+    checks = [completeness, uniqueness, validity, consistency, timeliness]
+    with ThreadPoolExecutor(max_workers=len(checks)) as ex:
+        futs = {f.__name__: ex.submit(f) for f in checks}
+        results = {}
+        for name, fut in futs.items():
+            results[name] = fut.result()
+            print(f"[DQ] {name.capitalize()} OK")
+
+    pq.write_table(pa.Table.from_pandas(snapshot(results), preserve_index=False),
+                   OUTPUT_CSV.parent / "snapshot.parquet", compression="zstd")
+    if args.csv:
+        write_csvs(results)
+
+    # Gráficos na thread principal (o estado do matplotlib não é thread-safe)
+    save_bar(results["completeness"], "feature", "completeness_pct", "Completeness (%) por coluna crítica", "01_completeness.png")
+    save_bar(results["uniqueness"], "entity", "duplicates", "Duplicatas por chave natural (staging)", "02_uniqueness.png")
+    save_bar(results["validity"], "rule", "pass_pct", "Validity: % linhas que passam as regras", "03_validity.png")
+    save_bar(results["consistency"], "rule", "pass_pct", "Consistency: % linhas que passam as regras", "04_consistency.png")
+
+    lead_df, ontime_df = results["timeliness"]
+    save_hist(lead_df, title="Distribuição do Lead Time (dias)", fname="05_timeliness_lead_hist.png")
 
     # gráfico de barra simples para taxa on-time
     df = ontime_df.copy()
@@ -229,20 +448,6 @@ def timeliness():
     df["value"] = df["ontime_pct"].round(2)
     df = df[["metric","value"]]
     save_bar(df, "metric", "value", "Timeliness: % de entregas no prazo", "06_timeliness_on_time.png")
-    return lead_df, ontime_df
-
-def main():
-    print("[DQ] Iniciando monitoramento...")
-    completeness()
-    print("[DQ] Completeness OK")
-    uniqueness()
-    print("[DQ] Uniqueness OK")
-    validity()
-    print("[DQ] Validity OK")
-    consistency()
-    print("[DQ] Consistency OK")
-    timeliness()
-    print("[DQ] Timeliness OK")
     print("[DQ] Relatórios salvos na pasta monitoring/.")
 
 if __name__ == "__main__":
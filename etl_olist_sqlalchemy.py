@@ -1,8 +1,13 @@
 # Bibliotecas
 import os
+import re
+import atexit
+import threading
 from pathlib import Path
 from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import URL
 
@@ -12,6 +17,9 @@ load_dotenv()
 DATA_DIR = Path(os.getenv("DATA_DIR", "data/raw"))
 DDL_PATH = Path("ddl_olist.sql")   # DDL opcional (SEM CREATE DATABASE!)
 
+# Segurança: linhas com CREATE DATABASE são removidas do DDL antes de aplicar
+_DROP_CREATEDB = re.compile(r"^[ \t]*CREATE[ \t]+DATABASE\b.*$", re.IGNORECASE | re.MULTILINE)
+
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = int(os.getenv("DB_PORT", "5432"))
 DB_NAME = os.getenv("DB_NAME", "olist")
@@ -27,6 +35,10 @@ url_target = URL.create("postgresql+psycopg2", username=DB_USER, password=DB_PAS
 # Engine principal (somente será usada depois de garantir que o DB existe)
 engine = create_engine(url_target, pool_pre_ping=True)
 
+# COPY: arquivo aberto em binário e enviado ao libpq em blocos de 1 MiB
+# (o padrão do copy_expert é 8 KiB por read())
+COPY_BUFSIZE = 1 << 20
+
 # Arquivos esperados (nome do arquivo -> tabela de staging)
 FILES = {
   "olist_stage.raw_customers": "olist_customers_dataset.csv",
@@ -63,21 +75,71 @@ def exec_sql(sql: str):
     with engine.begin() as conn:
         conn.execute(text(sql))
 
+def batch_insert(table: str, cols, rows, page_size: int = 10000):
+    """
+    INSERT em lote (psycopg2 execute_values) para cargas delta que não vêm de CSV.
+    Use no lugar de executemany, que faz um round-trip por linha.
+    page_size entre 1k e 10k linhas por comando: acima disso o ganho no Postgres
+    é marginal e só aumenta a memória do comando montado.
+    """
+    with closing(engine.raw_connection()) as raw_conn, \
+         closing(raw_conn.cursor()) as cur:
+        try:
+            execute_values(
+                cur,
+                f"INSERT INTO {table} ({', '.join(cols)}) VALUES %s",
+                rows,
+                page_size=page_size,
+            )
+            raw_conn.commit()
+        except Exception:
+            raw_conn.rollback()
+            raise
+
+# Conexões DBAPI reaproveitadas por thread nos COPYs (evita checkout + pre-ping a cada CSV)
+_tls = threading.local()
+_raw_conns = []
+_raw_lock = threading.Lock()
+
+def _raw():
+    """
+    Conexão psycopg2 (engine.raw_connection()) da thread atual, aberta na
+    primeira chamada e reaproveitada nas seguintes até _close_raw().
+    """
+    raw_conn = getattr(_tls, "raw_conn", None)
+    if raw_conn is None or raw_conn.dbapi_connection is None:  # None = já devolvida ao pool
+        raw_conn = _tls.raw_conn = engine.raw_connection()
+        with _raw_lock:
+            _raw_conns.append(raw_conn)
+    return raw_conn
+
+def _close_raw():
+    """Devolve ao pool todas as conexões abertas por _raw(), de qualquer thread."""
+    with _raw_lock:
+        while _raw_conns:
+            _raw_conns.pop().close()
+
+atexit.register(_close_raw)
+
 def copy_from_csv(table: str, csv_path: Path):
     """
     Faz COPY FROM STDIN (server-side) do CSV para a tabela 'table'.
-    Usa closing() pois raw_connection() não é context manager no SQLAlchemy 2.x.
+    Usa a conexão da thread atual (_raw()), então pode rodar em paralelo
+    com uma conexão por thread.
     """
     if not csv_path.exists():
         raise FileNotFoundError(f"CSV não encontrado: {csv_path}")
 
-    with closing(engine.raw_connection()) as raw_conn, \
-         closing(raw_conn.cursor()) as cur, \
-         open(csv_path, "r", encoding="utf-8") as f:
+    raw_conn = _raw()
+    with closing(raw_conn.cursor()) as cur, \
+         open(csv_path, "rb", buffering=COPY_BUFSIZE) as f:
         try:
+            # staging é recarregado a cada execução: dispensa esperar o fsync do WAL no commit
+            cur.execute("SET LOCAL synchronous_commit = off")
             cur.copy_expert(
-                f"COPY {table} FROM STDIN WITH (FORMAT CSV, HEADER true)",
-                f
+                f"COPY {table} FROM STDIN WITH (FORMAT CSV, HEADER true, ENCODING 'UTF8')",
+                f,
+                size=COPY_BUFSIZE,
             )
             raw_conn.commit()
         except Exception:
@@ -91,41 +153,73 @@ def load_staging():
 
     # 2) (Opcional) aplicar DDL (SEM CREATE DATABASE)
     if DDL_PATH.exists():
-        ddl = DDL_PATH.read_text(encoding="utf-8")
-
         # Segurança: remove linhas com CREATE DATABASE, caso alguém esqueça no arquivo
-        safe_lines = []
-        for ln in ddl.splitlines():
-            if ln.strip().upper().startswith("CREATE DATABASE"):
-                continue
-            safe_lines.append(ln)
-        ddl = "\n".join(safe_lines)
-
+        ddl = _DROP_CREATEDB.sub("", DDL_PATH.read_text(encoding="utf-8"))
         exec_sql(ddl)
 
-    # 3) TRUNCATE staging (idempotente)
+    # 3) TRUNCATE staging (idempotente) + remove índices secundários do staging,
+    #    para o COPY não manter índice linha a linha (recriados no passo 5)
     with engine.begin() as conn:
         for tbl in FILES.keys():
             conn.execute(text(f"TRUNCATE {tbl}"))
+        staging_indexes = conn.execute(text("""
+            SELECT format('%I.%I', i.schemaname, i.indexname), i.indexdef
+            FROM pg_indexes i
+            WHERE i.schemaname = 'olist_stage'
+              AND NOT EXISTS (  -- índices de PK/UNIQUE pertencem a constraints
+                SELECT 1 FROM pg_constraint c
+                WHERE c.conindid = format('%I.%I', i.schemaname, i.indexname)::regclass
+              )
+        """)).all()
+        for idx_name, _ in staging_indexes:
+            conn.execute(text(f"DROP INDEX IF EXISTS {idx_name}"))
 
-    # 4) COPY de cada CSV para o staging
-    for table, fname in FILES.items():
-        path = DATA_DIR / fname
-        copy_from_csv(table, path)
+    # 4) COPY de cada CSV para o staging, em paralelo (tabelas distintas, sem disputa de lock)
+    try:
+        with ThreadPoolExecutor(max_workers=min(8, len(FILES))) as ex:
+            list(ex.map(copy_from_csv, FILES.keys(), (DATA_DIR / fname for fname in FILES.values())))
+    finally:
+        _close_raw()
+        # 5) Recria os índices de uma vez (build em lote), mesmo se algum COPY falhar:
+        #    as definições só existem em staging_indexes, não sobrevivem a esta execução
+        with engine.begin() as conn:
+            conn.execute(text("SET LOCAL maintenance_work_mem = '1GB'"))
+            for _, idx_def in staging_indexes:
+                conn.execute(text(idx_def))
+
+    # 6) Atualiza estatísticas do staging
+    with engine.begin() as conn:
+        for tbl in FILES.keys():
+            conn.execute(text(f"ANALYZE {tbl}"))
 
     print("[STAGING] COPY concluído.")
 
 # ETL: DW (transform + load)
 def upsert_dim_date():
     exec_sql("""
-    WITH d AS (
-      SELECT DISTINCT DATE(order_purchase_timestamp) AS d FROM olist_stage.raw_orders WHERE order_purchase_timestamp IS NOT NULL
-      UNION SELECT DISTINCT DATE(order_approved_at) FROM olist_stage.raw_orders WHERE order_approved_at IS NOT NULL
-      UNION SELECT DISTINCT DATE(order_delivered_customer_date) FROM olist_stage.raw_orders WHERE order_delivered_customer_date IS NOT NULL
-      UNION SELECT DISTINCT DATE(order_estimated_delivery_date) FROM olist_stage.raw_orders WHERE order_estimated_delivery_date IS NOT NULL
-      UNION SELECT DISTINCT DATE(shipping_limit_date) FROM olist_stage.raw_order_items WHERE shipping_limit_date IS NOT NULL
-      UNION SELECT DISTINCT DATE(review_creation_date) FROM olist_stage.raw_reviews WHERE review_creation_date IS NOT NULL
-      UNION SELECT DISTINCT DATE(review_answer_timestamp) FROM olist_stage.raw_reviews WHERE review_answer_timestamp IS NOT NULL
+    -- calendário contínuo entre a menor e a maior data do staging (1 scan por tabela)
+    WITH bounds AS (
+      SELECT LEAST(o.lo, i.lo, r.lo) AS lo, GREATEST(o.hi, i.hi, r.hi) AS hi
+      FROM (
+        SELECT LEAST(MIN(order_purchase_timestamp), MIN(order_approved_at),
+                     MIN(order_delivered_customer_date), MIN(order_estimated_delivery_date))::date AS lo,
+               GREATEST(MAX(order_purchase_timestamp), MAX(order_approved_at),
+                        MAX(order_delivered_customer_date), MAX(order_estimated_delivery_date))::date AS hi
+        FROM olist_stage.raw_orders
+      ) o,
+      (
+        SELECT MIN(shipping_limit_date)::date AS lo, MAX(shipping_limit_date)::date AS hi
+        FROM olist_stage.raw_order_items
+      ) i,
+      (
+        SELECT LEAST(MIN(review_creation_date), MIN(review_answer_timestamp))::date AS lo,
+               GREATEST(MAX(review_creation_date), MAX(review_answer_timestamp))::date AS hi
+        FROM olist_stage.raw_reviews
+      ) r
+    ),
+    d AS (
+      SELECT g::date AS d
+      FROM bounds, generate_series(bounds.lo::timestamp, bounds.hi::timestamp, interval '1 day') g
     )
     INSERT INTO olist_dw.dim_date (date_id, year, quarter, month, day, week, dow)
     SELECT d,
@@ -183,8 +277,26 @@ def upsert_dim_product():
     """)
 
 def insert_fact_items():
+    """
+    Recarga completa da fato (o staging é sempre recarregado por inteiro):
+    o JOIN pesado é materializado numa tabela UNLOGGED intermediária e depois
+    a fato é trocada com TRUNCATE + INSERT, sem ON CONFLICT (sem probe no
+    índice único por linha). Tudo numa única transação (exec_sql).
+    Para carga incremental, filtrar por o.order_purchase_timestamp >= watermark
+    e voltar a usar ON CONFLICT (order_id, order_item_id).
+    """
     exec_sql("""
-    INSERT INTO olist_dw.fact_order_item
+    CREATE UNLOGGED TABLE IF NOT EXISTS olist_dw._stg_fact_order_item AS
+      SELECT order_id, order_item_id, customer_sk, seller_sk, product_sk,
+             purchase_date_id, approved_date_id, shipping_limit_date_id,
+             delivered_customer_date_id, estimated_delivery_date_id,
+             order_status, price, freight_value
+      FROM olist_dw.fact_order_item
+    WITH NO DATA;
+
+    TRUNCATE olist_dw._stg_fact_order_item;
+
+    INSERT INTO olist_dw._stg_fact_order_item
       (order_id, order_item_id, customer_sk, seller_sk, product_sk,
        purchase_date_id, approved_date_id, shipping_limit_date_id,
        delivered_customer_date_id, estimated_delivery_date_id,
@@ -205,18 +317,22 @@ def insert_fact_items():
       i.freight_value
     FROM olist_stage.raw_order_items i
     JOIN olist_stage.raw_orders o         ON o.order_id = i.order_id
-    JOIN olist_stage.raw_customers c      ON c.customer_id = o.customer_id
-    JOIN olist_stage.raw_sellers s        ON s.seller_id = i.seller_id
-    JOIN olist_stage.raw_products p       ON p.product_id = i.product_id
-    JOIN olist_dw.dim_customer dc         ON dc.customer_id = c.customer_id
-    JOIN olist_dw.dim_seller ds           ON ds.seller_id   = s.seller_id
-    JOIN olist_dw.dim_product dp          ON dp.product_id  = p.product_id
-    ON CONFLICT (order_id, order_item_id)
-    DO UPDATE SET
-      price = EXCLUDED.price,
-      freight_value = EXCLUDED.freight_value,
-      order_status = EXCLUDED.order_status,
-      delivered_customer_date_id = EXCLUDED.delivered_customer_date_id;
+    JOIN olist_dw.dim_customer dc         ON dc.customer_id = o.customer_id
+    JOIN olist_dw.dim_seller ds           ON ds.seller_id   = i.seller_id
+    JOIN olist_dw.dim_product dp          ON dp.product_id  = i.product_id;
+
+    TRUNCATE olist_dw.fact_order_item;
+
+    INSERT INTO olist_dw.fact_order_item
+      (order_id, order_item_id, customer_sk, seller_sk, product_sk,
+       purchase_date_id, approved_date_id, shipping_limit_date_id,
+       delivered_customer_date_id, estimated_delivery_date_id,
+       order_status, price, freight_value)
+    SELECT order_id, order_item_id, customer_sk, seller_sk, product_sk,
+           purchase_date_id, approved_date_id, shipping_limit_date_id,
+           delivered_customer_date_id, estimated_delivery_date_id,
+           order_status, price, freight_value
+    FROM olist_dw._stg_fact_order_item;
     """)
 
 def insert_fact_payments():
@@ -241,6 +357,19 @@ def transform_load_dw():
     upsert_dim_product()
     insert_fact_items()
     insert_fact_payments()
+    # totais por pedido usados na conciliação do monitoramento de DQ
+    exec_sql("REFRESH MATERIALIZED VIEW CONCURRENTLY olist_dw.mv_order_totals;")
+    # estatísticas atualizadas já para o próximo uso (ex.: monitoramento de DQ),
+    # sem depender do autovacuum
+    exec_sql("""
+    ANALYZE olist_dw.fact_order_item;
+    ANALYZE olist_dw.fact_payment;
+    ANALYZE olist_dw.dim_customer;
+    ANALYZE olist_dw.dim_seller;
+    ANALYZE olist_dw.dim_product;
+    ANALYZE olist_dw.dim_date;
+    ANALYZE olist_dw.mv_order_totals;
+    """)
     print("[DW] Dimensões e fatos populados.")
 
 def run():